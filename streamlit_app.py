@@ -1,10 +1,22 @@
 import streamlit as st
-import anthropic
-import json
-import base64
+import orjson
+import jsonschema
+try:
+    from pybase64 import b64encode
+except ImportError:  # SIMD encoder is optional; the stdlib output is identical
+    from base64 import b64encode
 from datetime import datetime
-from PIL import Image
+import pandas as pd
 import io
+import tempfile
+from pathlib import Path
+import hashlib
+import html
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+from collections import OrderedDict
 
 # Page config
 st.set_page_config(
@@ -14,332 +26,821 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Custom CSS for better styling
-st.markdown("""
-<style>
-    .main-header {
-        background: linear-gradient(90deg, #1e40af, #3b82f6);
-        padding: 2rem;
-        border-radius: 10px;
-        color: white;
-        text-align: center;
-        margin-bottom: 2rem;
+@st.cache_data(show_spinner=False)
+def load_css():
+    """Read the custom stylesheet once per process instead of on every rerun"""
+    return f"<style>\n{(Path(__file__).parent / 'style.css').read_text()}</style>"
+
+# Custom CSS for better styling; Streamlit drops elements that are not
+# re-emitted, so it must still be injected on every run
+st.markdown(load_css(), unsafe_allow_html=True)
+
+# Longest image side (px) sent to the model for each detail level
+DETAIL_LEVELS = {
+    "Low": 768,
+    "High": 1568
+}
+
+# Cheap model tried first and the stronger model used as fallback
+FAST_MODEL = "claude-3-5-haiku-20241022"
+ACCURATE_MODEL = "claude-3-5-sonnet-20241022"
+
+# Models tried in order for each "Quality vs cost" setting
+QUALITY_MODES = {
+    "Economy": (FAST_MODEL, ACCURATE_MODEL),
+    "Quality": (ACCURATE_MODEL,)
+}
+
+# JSON Schema of the extracted data, used as tool input and for validation
+_STRING = {"type": "string"}
+_NUMBER = {"type": "number"}
+INVOICE_JSON_SCHEMA = {
+    "type": "object",
+    "required": ["invoice"],
+    "properties": {
+        "invoice": {
+            "type": "object",
+            "required": ["header", "billing_parties", "line_items", "totals"],
+            "properties": {
+                "header": {
+                    "type": "object",
+                    "required": ["invoice_number", "invoice_date", "due_date", "issuing_company", "currency"],
+                    "properties": {
+                        "invoice_number": _STRING,
+                        "invoice_date": _STRING,
+                        "due_date": _STRING,
+                        "issuing_company": _STRING,
+                        "currency": _STRING
+                    }
+                },
+                "billing_parties": {
+                    "type": "object",
+                    "required": ["bill_to", "bill_from"],
+                    "properties": {
+                        "bill_to": {
+                            "type": "object",
+                            "required": ["company_name"],
+                            "properties": {
+                                "company_name": _STRING,
+                                "address": _STRING,
+                                "organization_number": _STRING,
+                                "vat_number": _STRING
+                            }
+                        },
+                        "bill_from": {
+                            "type": "object",
+                            "required": ["company_name"],
+                            "properties": {
+                                "company_name": _STRING,
+                                "address": _STRING,
+                                "organization_number": _STRING,
+                                "vat_number": _STRING,
+                                "phone": _STRING,
+                                "email": _STRING,
+                                "reference": _STRING
+                            }
+                        }
+                    }
+                },
+                "line_items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["description", "line_total"],
+                        "properties": {
+                            "line_number": {"type": "integer"},
+                            "description": _STRING,
+                            "quantity": _NUMBER,
+                            "unit_of_measure": _STRING,
+                            "unit_price": _NUMBER,
+                            "discount_percentage": {"type": "number", "description": "As a decimal, e.g. 0.05 for 5%"},
+                            "line_total": _NUMBER,
+                            "vat_rate": {"type": "number", "description": "As a decimal, e.g. 0.20 for 20%"},
+                            "vat_amount": _NUMBER
+                        }
+                    }
+                },
+                "totals": {
+                    "type": "object",
+                    "required": ["total_amount", "balance_due"],
+                    "properties": {
+                        "subtotal": _NUMBER,
+                        "total_discount": _NUMBER,
+                        "total_vat": _NUMBER,
+                        "total_amount": _NUMBER,
+                        "amount_paid": _NUMBER,
+                        "balance_due": _NUMBER
+                    }
+                },
+                "payment_info": {
+                    "type": "object",
+                    "properties": {
+                        "bank_name": _STRING,
+                        "iban": _STRING,
+                        "swift_bic": _STRING,
+                        "payment_reference": _STRING
+                    }
+                }
+            }
+        }
     }
+}
+
+# Bump whenever the prompt, tool or schema changes so cached results made
+# with the old version are evicted and re-extracted
+PROMPT_VERSION = "1"
+
+# Instructions sent as the system prompt; must stay byte-stable between
+# requests for the prompt cache to hit
+EXTRACTION_PROMPT = (
+    "Extract all invoice data from the image with the record_invoice tool. "
+    "Be precise with numbers and dates. "
+    "If information is not available, use empty string or 0 for numbers."
+)
+
+# Tool the model is forced to call, so its input is the extracted invoice
+INVOICE_TOOL = {
+    "name": "record_invoice",
+    "description": "Record the structured data extracted from an invoice image.",
+    "input_schema": INVOICE_JSON_SCHEMA
+}
+
+# Line item table columns, formatted by st.dataframe rather than per row
+LINE_ITEM_COLUMNS = {
+    "line_number": st.column_config.NumberColumn("#", format="%d"),
+    "description": st.column_config.TextColumn("Description"),
+    "quantity": st.column_config.NumberColumn("Qty"),
+    "unit_of_measure": st.column_config.TextColumn("Unit"),
+    "unit_price": st.column_config.NumberColumn("Unit Price", format="%.2f"),
+    "discount_percentage": st.column_config.NumberColumn("Discount", format="%.0f%%"),
+    "line_total": st.column_config.NumberColumn("Subtotal", format="%.2f"),
+    "vat_amount": st.column_config.NumberColumn("VAT", format="%.2f"),
+    "vat_rate": st.column_config.NumberColumn("VAT Rate", format="%.0f%%")
+}
+
+# Static HTML fragments, rendered with st.html to skip markdown parsing
+_STATUS_OUTSTANDING = '<span class="status-outstanding">Outstanding</span>'
+_STATUS_PAID = '<span class="status-paid">Paid</span>'
+_SECTION_HEADER = '<div class="section-header">{}</div>'
+_CARD = '<div class="invoice-card">' + _SECTION_HEADER + '{}</div>'
+
+# JSON text optionally wrapped in a Markdown code fence
+_FENCE_RE = re.compile(r"^\s*```(?:[a-z0-9]+)?\s*(.*?)\s*```\s*$", re.S)
+
+# Summary CSV columns, one row per extracted invoice
+SUMMARY_CSV_COLUMNS = [
+    "filename", "invoice_number", "company", "total_amount",
+    "currency", "balance_due", "invoice_date", "due_date"
+]
+
+# Times a model is asked to correct a response that fails schema
+# validation before escalating to the next model
+FEEDBACK_RETRIES = 1
+
+# Maximum number of invoices extracted at the same time in batch processing
+MAX_CONCURRENT_EXTRACTIONS = 5
+
+# Automatic retries for rate limits (429), overload (529), timeouts and
+# connection errors; the SDK backs off exponentially and honors retry-after
+API_MAX_RETRIES = 5
+
+# Maximum number of Anthropic API calls in flight per server process,
+# across all user sessions
+MAX_CONCURRENT_API_CALLS = 16
+
+# Maximum number of extraction results kept in memory
+EXTRACTION_CACHE_SIZE = 128
+
+# Directory where extraction results are cached on disk, keyed by content hash;
+# anchored to the app so it does not depend on where streamlit is started
+EXTRACTION_CACHE_DIR = Path(__file__).parent / ".invoice_cache"
+
+# Maximum number of extraction results kept on disk; least recently used
+# entries are deleted first
+EXTRACTION_DISK_CACHE_SIZE = 1000
+
+# Output token ceiling for an extraction; only tokens generated are billed,
+# so it is sized for invoices with many line items
+INVOICE_MAX_TOKENS = 4096
+
+# Typical length of the extracted JSON, used to scale the streaming progress bar
+EXPECTED_RESPONSE_CHARS = 4000
+
+# Seconds between batch status checks; doubles after each check up to the max
+BATCH_POLL_INITIAL = 5
+BATCH_POLL_MAX = 300
+
+# Maximum number of line item tables kept in memory
+LINE_ITEMS_CACHE_SIZE = 64
+
+# Longest side (px) of the upload previews
+PREVIEW_SIZE = 1024
+
+# Maximum number of upload previews kept in memory
+PREVIEW_CACHE_SIZE = 64
+
+# Recompressed JPEGs larger than this spill from memory to a temp file
+JPEG_SPOOL_SIZE = 2 * 1024 * 1024
+
+# Read size for streaming base64; a multiple of 3 so no chunk gets padded
+B64_CHUNK_SIZE = 57 * 1024
+
+def _encode_base64(fileobj, size):
+    """Base64-encode a file chunk by chunk into an exactly preallocated buffer"""
+    # Streaming keeps the raw bytes and their base64 form from both sitting
+    # in memory in full
+    encoded = bytearray(4 * -(-size // 3))
+    pos = 0
+    while chunk := fileobj.read(B64_CHUNK_SIZE):
+        encoded_chunk = b64encode(chunk)
+        encoded[pos:pos + len(encoded_chunk)] = encoded_chunk
+        pos += len(encoded_chunk)
+    return encoded.decode('ascii')
+
+def _flatten_to_rgb(img):
+    """Convert an image to RGB, compositing transparency onto white rather than black"""
+    from PIL import Image
     
-    .invoice-card {
-        background: white;
-        padding: 1.5rem;
-        border-radius: 8px;
-        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        margin-bottom: 1rem;
-    }
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        flattened = Image.new("RGB", img.size, "white")
+        flattened.paste(img, mask=img.getchannel("A"))
+        return flattened
+    return img.convert("RGB")
+
+def encode_image(image_bytes, max_side=DETAIL_LEVELS["High"]):
+    """Downscale uploaded image, recompress it as JPEG and stream it to base64"""
+    from PIL import Image, ImageOps
     
-    .status-outstanding {
-        background-color: #fee2e2;
-        color: #dc2626;
-        padding: 0.25rem 0.75rem;
-        border-radius: 9999px;
-        font-size: 0.75rem;
-        font-weight: 600;
-        display: inline-block;
-    }
+    img = Image.open(io.BytesIO(image_bytes))
     
-    .status-paid {
-        background-color: #dcfce7;
-        color: #16a34a;
-        padding: 0.25rem 0.75rem;
-        border-radius: 9999px;
-        font-size: 0.75rem;
-        font-weight: 600;
-        display: inline-block;
-    }
+    # JPEGs that already fit are sent as uploaded, skipping a lossy re-encode
+    if img.format == "JPEG" and img.mode in ("RGB", "L") and max(img.size) <= max_side:
+        return _encode_base64(io.BytesIO(image_bytes), len(image_bytes))
     
-    .amount-large {
-        font-size: 2rem;
-        font-weight: bold;
-        color: #1f2937;
-    }
+    img.draft('RGB', (max_side, max_side))
+    # The re-encode drops EXIF, so apply its orientation to the pixels first
+    img = ImageOps.exif_transpose(img)
+    # Convert before downscaling: Pillow resamples "1" and "P" images with
+    # NEAREST, which drops thin lines from bilevel and palette scans
+    img = _flatten_to_rgb(img)
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    with tempfile.SpooledTemporaryFile(max_size=JPEG_SPOOL_SIZE) as jpeg:
+        img.save(jpeg, format="JPEG", quality=85, optimize=True)
+        size = jpeg.tell()
+        jpeg.seek(0)
+        return _encode_base64(jpeg, size)
+
+@st.cache_data(show_spinner=False, max_entries=PREVIEW_CACHE_SIZE)
+def build_preview(image_bytes):
+    """Shrink an upload to JPEG preview bytes once, returning them with the original size"""
+    from PIL import ExifTags, Image, ImageOps
+    
+    img = Image.open(io.BytesIO(image_bytes))
+    width, height = img.size
+    # Report the size as displayed: EXIF orientations 5-8 rotate by 90 degrees
+    if img.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+        width, height = height, width
+    # Let libjpeg decode at a reduced scale; no-op for PNG
+    img.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+    img = _flatten_to_rgb(ImageOps.exif_transpose(img))
+    img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    preview = io.BytesIO()
+    img.save(preview, format="JPEG", quality=80)
+    return preview.getvalue(), (width, height)
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key):
+    """Create one Anthropic client per API key, reused across reruns"""
+    # Imported lazily to keep the SDK out of cold start until it is needed
+    import anthropic
     
-    .section-header {
-        color: #374151;
-        font-weight: 600;
-        font-size: 1.1rem;
-        margin-bottom: 1rem;
-        padding-bottom: 0.5rem;
-        border-bottom: 2px solid #e5e7eb;
+    return anthropic.Anthropic(api_key=api_key, max_retries=API_MAX_RETRIES)
+
+@st.cache_resource(show_spinner=False)
+def get_api_semaphore():
+    """Process-wide cap on concurrent API calls, shared by all sessions"""
+    return threading.BoundedSemaphore(MAX_CONCURRENT_API_CALLS)
+
+def build_invoice_request(image_base64, model=FAST_MODEL):
+    """Build the Messages API parameters for extracting one invoice image"""
+    return {
+        "model": model,
+        "max_tokens": INVOICE_MAX_TOKENS,
+        "tools": [INVOICE_TOOL],
+        "tool_choice": {"type": "tool", "name": INVOICE_TOOL["name"]},
+        # Tools and system prompt are identical on every request, so mark
+        # them as a cacheable prefix; only the image after them changes
+        "system": [{
+            "type": "text",
+            "text": EXTRACTION_PROMPT,
+            "cache_control": {"type": "ephemeral"}
+        }],
+        "messages": [{
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": "image/jpeg",
+                        "data": image_base64
+                    }
+                }
+            ]
+        }]
     }
-</style>
-""", unsafe_allow_html=True)
 
-def encode_image(image_file):
-    """Convert uploaded image to base64"""
-    return base64.b64encode(image_file.read()).decode('utf-8')
+def _unwrap_json_text(value):
+    """Decode a section the model returned as (possibly fenced) JSON text"""
+    if not isinstance(value, str):
+        return value
+    match = _FENCE_RE.match(value)
+    try:
+        return orjson.loads(match.group(1) if match else value)
+    except orjson.JSONDecodeError:
+        return value
 
-def extract_invoice_data(image_base64, api_key):
-    """Extract structured data from invoice image using Anthropic API"""
+def parse_invoice_response(message):
+    """Read the invoice data out of a record_invoice tool call and validate it"""
+    data = next((block.input for block in message.content if block.type == "tool_use"), {})
     
-    client = anthropic.Anthropic(api_key=api_key)
+    # Models occasionally pass nested objects as JSON strings; recover them
+    # here instead of failing validation and paying for a retry
+    invoice = data["invoice"] = _unwrap_json_text(data.get("invoice"))
+    if isinstance(invoice, dict):
+        for section, value in invoice.items():
+            invoice[section] = _unwrap_json_text(value)
     
-    invoice_schema = {
-        "invoice": {
-            "header": {
-                "invoice_number": "",
-                "invoice_date": "",
-                "due_date": "",
-                "issuing_company": "",
-                "currency": ""
-            },
-            "billing_parties": {
-                "bill_to": {
-                    "company_name": "",
-                    "address": "",
-                    "organization_number": "",
-                    "vat_number": ""
-                },
-                "bill_from": {
-                    "company_name": "",
-                    "address": "",
-                    "organization_number": "",
-                    "vat_number": "",
-                    "phone": "",
-                    "email": "",
-                    "reference": ""
-                }
-            },
-            "line_items": [],
-            "totals": {
-                "subtotal": 0,
-                "total_discount": 0,
-                "total_vat": 0,
-                "total_amount": 0,
-                "amount_paid": 0,
-                "balance_due": 0
-            },
-            "payment_info": {
-                "bank_name": "",
-                "iban": "",
-                "swift_bic": "",
-                "payment_reference": ""
-            }
+    jsonschema.validate(data, INVOICE_JSON_SCHEMA)
+    return data
+
+def _stream_invoice_message(request, client, on_progress=None):
+    """Stream one Messages API call, reporting tool input characters received"""
+    with get_api_semaphore():
+        with client.messages.stream(**request) as stream:
+            received = 0
+            for event in stream:
+                if event.type == "input_json":
+                    received += len(event.partial_json)
+                    if on_progress:
+                        on_progress(received)
+            return stream.get_final_message()
+
+def request_invoice_data(image_base64, client, model=FAST_MODEL, on_progress=None):
+    """Extract structured data from invoice image using Anthropic API
+    
+    A response that fails validation is returned to the model as an error
+    tool result so it can correct it, which is cheaper than starting over.
+    """
+    request = build_invoice_request(image_base64, model)
+    for attempt in range(FEEDBACK_RETRIES + 1):
+        response = _stream_invoice_message(request, client, on_progress)
+        try:
+            return parse_invoice_response(response)
+        except jsonschema.ValidationError as e:
+            tool_use = next((block for block in response.content if block.type == "tool_use"), None)
+            if tool_use is None or attempt == FEEDBACK_RETRIES:
+                raise
+            request["messages"] = request["messages"] + [
+                {"role": "assistant", "content": response.content},
+                {"role": "user", "content": [{
+                    "type": "tool_result",
+                    "tool_use_id": tool_use.id,
+                    "is_error": True,
+                    "content": f"Invalid invoice data: {e.message}. Call {INVOICE_TOOL['name']} again with corrected data."
+                }]}
+            ]
+
+def describe_error(error):
+    """Summarize an extraction failure for display"""
+    # str() of a ValidationError embeds the whole invoice schema
+    if isinstance(error, jsonschema.ValidationError):
+        return f"invalid invoice data at {error.json_path}: {error.message}"
+    return str(error)
+
+def extraction_cache_key(image_bytes, max_side, models):
+    """Content hash of everything that determines an extraction result"""
+    digest = hashlib.sha256()
+    # Length-prefix each part so different splits of the input cannot collide
+    for part in (str(max_side).encode(), ",".join(models).encode(), image_bytes):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def get_extraction_cache():
+    """Process-wide LRU store of extraction results and the lock guarding it"""
+    # Not st.cache_data: that replays element calls made while the function runs,
+    # which breaks rendering streaming progress into a progress bar. The lock is
+    # needed because extract_many workers read and evict concurrently
+    return OrderedDict(), threading.Lock()
+
+def read_cached_extraction(cache_key):
+    """Load a result from the disk cache, evicting it if made by an older prompt"""
+    path = EXTRACTION_CACHE_DIR / f"{cache_key}.json"
+    try:
+        entry = orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    
+    if not isinstance(entry, dict) or entry.get("prompt_version") != PROMPT_VERSION:
+        path.unlink(missing_ok=True)
+        return None
+    
+    # Mark the entry as recently used for trimming
+    try:
+        path.touch()
+    except OSError:
+        pass
+    return entry.get("data")
+
+def _trim_disk_cache():
+    """Delete the least recently used disk cache entries beyond the size limit"""
+    entries = []
+    for path in EXTRACTION_CACHE_DIR.glob("*.json"):
+        try:
+            entries.append((path.stat().st_mtime, path))
+        except OSError:
+            pass
+    entries.sort()
+    for _, path in entries[:-EXTRACTION_DISK_CACHE_SIZE]:
+        path.unlink(missing_ok=True)
+
+def write_cached_extraction(cache_key, models, data):
+    """Store a result in the disk cache together with what produced it"""
+    path = EXTRACTION_CACHE_DIR / f"{cache_key}.json"
+    entry = {"prompt_version": PROMPT_VERSION, "models": list(models), "data": data}
+    try:
+        EXTRACTION_CACHE_DIR.mkdir(exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(orjson.dumps(entry))
+        tmp_path.replace(path)
+        _trim_disk_cache()
+    except OSError:
+        pass
+
+def clear_extraction_cache():
+    """Drop all cached results from memory and disk"""
+    cache, lock = get_extraction_cache()
+    with lock:
+        cache.clear()
+    # Include temp files left behind by interrupted writes
+    for pattern in ("*.json", "*.tmp"):
+        for path in EXTRACTION_CACHE_DIR.glob(pattern):
+            path.unlink(missing_ok=True)
+
+def _remember_extraction(cache_key, data):
+    """Add a result to the in-memory cache, evicting the least recently used"""
+    cache, lock = get_extraction_cache()
+    with lock:
+        cache[cache_key] = data
+        cache.move_to_end(cache_key)
+        while len(cache) > EXTRACTION_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def lookup_extraction(cache_key):
+    """Return the cached result for an extraction key from memory or disk, or None"""
+    cache, lock = get_extraction_cache()
+    with lock:
+        if cache_key in cache:
+            cache.move_to_end(cache_key)
+            return cache[cache_key]
+    
+    data = read_cached_extraction(cache_key)
+    if data is not None:
+        _remember_extraction(cache_key, data)
+    return data
+
+def extract_invoice_data(image_bytes, client, max_side=DETAIL_LEVELS["High"], models=QUALITY_MODES["Economy"], on_progress=None):
+    """Extract invoice data from image bytes, reusing cached results
+    
+    Models are tried in order, escalating to the next one when the response
+    does not match the invoice schema.
+    """
+    cache_key = extraction_cache_key(image_bytes, max_side, models)
+    data = lookup_extraction(cache_key)
+    if data is None:
+        image_base64 = encode_image(image_bytes, max_side)
+        for model in models:
+            try:
+                data = request_invoice_data(image_base64, client, model, on_progress)
+                break
+            except jsonschema.ValidationError:
+                if model == models[-1]:
+                    raise
+        write_cached_extraction(cache_key, models, data)
+        _remember_extraction(cache_key, data)
+    return data
+
+def extract_many(images, client, max_side=DETAIL_LEVELS["High"], models=QUALITY_MODES["Economy"], limit=MAX_CONCURRENT_EXTRACTIONS):
+    """Extract several invoices on a bounded thread pool
+    
+    Takes a mapping of file name to image bytes and yields (name, result)
+    pairs in completion order; failures are yielded as the exception
+    instead of a result.
+    """
+    with ThreadPoolExecutor(max_workers=min(limit, len(images))) as executor:
+        futures = {
+            executor.submit(extract_invoice_data, image_bytes, client, max_side, models): name
+            for name, image_bytes in images.items()
         }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+def submit_invoice_batch(images, client, max_side=DETAIL_LEVELS["High"], models=QUALITY_MODES["Economy"]):
+    """Submit invoices to the Message Batches API and remember the pending batch
+    
+    Batches have no escalation, so only the first model is used. Results are
+    cached under the same key as an interactive run with these models, which
+    would have returned the same data once the first model passed validation.
+    """
+    # Batch custom_ids only allow [a-zA-Z0-9_-], so map them back to file names
+    file_names = {f"invoice-{idx}": name for idx, name in enumerate(images)}
+    cache_keys = {
+        custom_id: extraction_cache_key(image_bytes, max_side, models)
+        for custom_id, image_bytes in zip(file_names, images.values())
     }
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_EXTRACTIONS, len(images))) as executor:
+        encoded = executor.map(lambda image_bytes: encode_image(image_bytes, max_side), images.values())
+        batch_requests = [
+            {"custom_id": custom_id, "params": build_invoice_request(image_base64, models[0])}
+            for custom_id, image_base64 in zip(file_names, encoded)
+        ]
     
-    try:
-        response = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=4000,
-            messages=[{
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": image_base64
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": f"""Extract all invoice data from this image and return it in the following JSON structure. Be precise with numbers and dates. If information is not available, use empty string or 0 for numbers.
-
-Required JSON structure:
-{json.dumps(invoice_schema, indent=2)}
-
-For line_items, each item should have:
-- line_number (integer)
-- description (string)
-- quantity (number)
-- unit_of_measure (string)
-- unit_price (number)
-- discount_percentage (number, as decimal like 0.05 for 5%)
-- line_total (number)
-- vat_rate (number, as decimal like 0.20 for 20%)
-- vat_amount (number)
-
-Return ONLY the JSON structure, no additional text."""
-                    }
-                ]
-            }]
-        )
-        
-        # Parse the JSON response
-        json_text = response.content[0].text.strip()
-        if json_text.startswith('```json'):
-            json_text = json_text[7:]
-        if json_text.endswith('```'):
-            json_text = json_text[:-3]
-            
-        return json.loads(json_text)
+    batch = client.messages.batches.create(requests=batch_requests)
+    st.session_state.invoice_batch = {
+        "id": batch.id,
+        "file_names": file_names,
+        "cache_keys": cache_keys,
+        "models": list(models),
+        "interval": BATCH_POLL_INITIAL,
+        "next_poll": time.time() + BATCH_POLL_INITIAL,
+        "status": batch.processing_status
+    }
+    return batch.id
+
+def collect_invoice_batch(batch, client):
+    """Parse the results of an ended batch into extracted data and failures
+    
+    Successful results also go to the extraction cache, so re-uploading the
+    same images after a reload does not pay for them again.
+    """
+    extracted, failed = {}, []
+    for entry in client.messages.batches.results(batch["id"]):
+        file_name = batch["file_names"].get(entry.custom_id, entry.custom_id)
+        try:
+            if entry.result.type != "succeeded":
+                raise ValueError(f"request {entry.result.type}")
+            data = extracted[file_name] = parse_invoice_response(entry.result.message)
+        except Exception as e:
+            failed.append(f"{file_name}: {describe_error(e)}")
+            continue
         
-    except Exception as e:
-        st.error(f"Error extracting data: {str(e)}")
-        return None
+        cache_key = batch.get("cache_keys", {}).get(entry.custom_id)
+        if cache_key:
+            write_cached_extraction(cache_key, batch["models"], data)
+            _remember_extraction(cache_key, data)
+    return extracted, failed
 
-def display_invoice_data(data):
-    """Display extracted invoice data in a nice format"""
+@st.fragment(run_every=BATCH_POLL_INITIAL)
+def poll_invoice_batch(client):
+    """Check the pending batch with exponential backoff and load finished results"""
+    batch = st.session_state.invoice_batch
     
-    if not data or 'invoice' not in data:
-        st.error("No invoice data to display")
-        return
+    if client and time.time() >= batch["next_poll"]:
+        status = client.messages.batches.retrieve(batch["id"])
+        batch["status"] = status.processing_status
+        batch["interval"] = min(batch["interval"] * 2, BATCH_POLL_MAX)
+        batch["next_poll"] = time.time() + batch["interval"]
+        
+        if status.processing_status == "ended":
+            extracted, failed = collect_invoice_batch(batch, client)
+            st.session_state.all_extracted_data.update(extracted)
+            st.session_state.batch_report = (len(extracted), failed)
+            del st.session_state.invoice_batch
+            st.rerun()
     
-    invoice = data['invoice']
+    wait = max(0, int(batch["next_poll"] - time.time()))
+    st.info(f"⏳ Batch `{batch['id']}` with {len(batch['file_names'])} invoice(s) is {batch['status']}. Next check in {wait}s.")
+
+def build_summary_csv(all_data):
+    """Collect one row per extracted invoice into the summary CSV"""
+    rows = []
+    for name, data in all_data.items():
+        invoice = data.get('invoice', {})
+        header = invoice.get('header', {})
+        totals = invoice.get('totals', {})
+        rows.append((
+            name,
+            header.get('invoice_number', ''),
+            invoice.get('billing_parties', {}).get('bill_from', {}).get('company_name', ''),
+            totals.get('total_amount', 0),
+            header.get('currency', ''),
+            totals.get('balance_due', 0),
+            header.get('invoice_date', ''),
+            header.get('due_date', '')
+        ))
+    
+    # object dtype keeps values as extracted instead of coercing ints to floats
+    summary = pd.DataFrame(rows, columns=SUMMARY_CSV_COLUMNS, dtype=object)
+    return summary.to_csv(index=False).encode()
+
+def _render_header(invoice):
+    """Render the invoice number, amount due, dates and status"""
+    hdr = invoice['header']
+    totals = invoice['totals']
     
     # Header section
-    st.markdown('<div class="main-header">', unsafe_allow_html=True)
     col1, col2 = st.columns([2, 1])
     
     with col1:
-        st.markdown(f"# INVOICE #{invoice['header'].get('invoice_number', 'N/A')}")
-        st.markdown(f"**{invoice['header'].get('issuing_company', 'N/A')}**")
+        st.markdown(f"# INVOICE #{hdr.get('invoice_number', 'N/A')}")
+        st.markdown(f"**{hdr.get('issuing_company', 'N/A')}**")
     
     with col2:
         st.markdown("### Amount Due")
-        amount = invoice['totals'].get('total_amount', 0)
-        currency = invoice['header'].get('currency', 'USD')
-        st.markdown(f'<div class="amount-large">{amount:,.2f} {currency}</div>', unsafe_allow_html=True)
-    
-    st.markdown('</div>', unsafe_allow_html=True)
+        st.html(f'<div class="amount-large">{totals.get("total_amount", 0):,.2f} {html.escape(hdr.get("currency", "USD"))}</div>')
     
     # Invoice details
     col1, col2, col3 = st.columns(3)
     
     with col1:
         st.markdown("**Invoice Date**")
-        st.write(invoice['header'].get('invoice_date', 'N/A'))
+        st.write(hdr.get('invoice_date', 'N/A'))
     
     with col2:
         st.markdown("**Due Date**") 
-        st.write(invoice['header'].get('due_date', 'N/A'))
+        st.write(hdr.get('due_date', 'N/A'))
     
     with col3:
         st.markdown("**Status**")
-        balance_due = invoice['totals'].get('balance_due', 0)
-        if balance_due > 0:
-            st.markdown('<span class="status-outstanding">Outstanding</span>', unsafe_allow_html=True)
+        if totals.get('balance_due', 0) > 0:
+            st.html(_STATUS_OUTSTANDING)
         else:
-            st.markdown('<span class="status-paid">Paid</span>', unsafe_allow_html=True)
+            st.html(_STATUS_PAID)
+
+def _party_card(title, party, contact_fields=()):
+    """Build the HTML for a Bill From / Bill To card as a single string"""
+    lines = [f"<p><strong>{html.escape(party.get('company_name', 'N/A'))}</strong></p>"]
+    for field, prefix in (('address', ''), *contact_fields):
+        if party.get(field):
+            lines.append(f"<p>{prefix}{html.escape(party[field])}</p>")
+    
+    if party.get('vat_number') or party.get('organization_number'):
+        lines.append("<hr>")
+        if party.get('vat_number'):
+            lines.append(f"<p>VAT: {html.escape(party['vat_number'])}</p>")
+        if party.get('organization_number'):
+            lines.append(f"<p>Org: {html.escape(party['organization_number'])}</p>")
+    
+    return _CARD.format(title, "".join(lines))
+
+def _render_billing_parties(invoice):
+    """Render the Bill From and Bill To cards"""
     
     # Billing parties
     col1, col2 = st.columns(2)
     
     with col1:
-        st.markdown('<div class="invoice-card">', unsafe_allow_html=True)
-        st.markdown('<div class="section-header">Bill From</div>', unsafe_allow_html=True)
-        
         bill_from = invoice['billing_parties']['bill_from']
-        st.markdown(f"**{bill_from.get('company_name', 'N/A')}**")
-        if bill_from.get('address'):
-            st.write(bill_from['address'])
-        if bill_from.get('phone'):
-            st.write(f"📞 {bill_from['phone']}")
-        if bill_from.get('email'):
-            st.write(f"📧 {bill_from['email']}")
-        
-        if bill_from.get('vat_number') or bill_from.get('organization_number'):
-            st.markdown("---")
-            if bill_from.get('vat_number'):
-                st.write(f"VAT: {bill_from['vat_number']}")
-            if bill_from.get('organization_number'):
-                st.write(f"Org: {bill_from['organization_number']}")
-        
-        st.markdown('</div>', unsafe_allow_html=True)
+        st.html(_party_card("Bill From", bill_from, (('phone', '📞 '), ('email', '📧 '))))
     
     with col2:
-        st.markdown('<div class="invoice-card">', unsafe_allow_html=True)
-        st.markdown('<div class="section-header">Bill To</div>', unsafe_allow_html=True)
-        
         bill_to = invoice['billing_parties']['bill_to']
-        st.markdown(f"**{bill_to.get('company_name', 'N/A')}**")
-        if bill_to.get('address'):
-            st.write(bill_to['address'])
-        
-        if bill_to.get('vat_number') or bill_to.get('organization_number'):
-            st.markdown("---")
-            if bill_to.get('vat_number'):
-                st.write(f"VAT: {bill_to['vat_number']}")
-            if bill_to.get('organization_number'):
-                st.write(f"Org: {bill_to['organization_number']}")
-        
-        st.markdown('</div>', unsafe_allow_html=True)
+        st.html(_party_card("Bill To", bill_to))
+
+@st.cache_data(show_spinner=False, max_entries=LINE_ITEMS_CACHE_SIZE)
+def build_line_items_frame(line_items):
+    """Shape line items into the table shown for an invoice, once per invoice"""
+    items = pd.DataFrame(line_items).reindex(columns=list(LINE_ITEM_COLUMNS))
+    items[['discount_percentage', 'vat_rate']] = items[['discount_percentage', 'vat_rate']].fillna(0) * 100
+    return items
+
+def _render_line_items(invoice):
+    """Render the line items table"""
     
     # Line items
-    st.markdown('<div class="section-header">Invoice Items</div>', unsafe_allow_html=True)
+    st.html(_SECTION_HEADER.format("Invoice Items"))
     
     if invoice.get('line_items'):
-        items_data = []
-        for item in invoice['line_items']:
-            items_data.append({
-                '#': item.get('line_number', ''),
-                'Description': item.get('description', ''),
-                'Qty': f"{item.get('quantity', 0)} {item.get('unit_of_measure', '')}".strip(),
-                'Unit Price': f"{item.get('unit_price', 0):,.2f}",
-                'Discount': f"{item.get('discount_percentage', 0)*100:.0f}%" if item.get('discount_percentage', 0) > 0 else "0%",
-                'Subtotal': f"{item.get('line_total', 0):,.2f}",
-                'VAT': f"{item.get('vat_amount', 0):,.2f} ({item.get('vat_rate', 0)*100:.0f}%)"
-            })
-        
-        st.dataframe(items_data, use_container_width=True, hide_index=True)
+        items = build_line_items_frame(invoice['line_items'])
+        st.dataframe(items, column_config=LINE_ITEM_COLUMNS, use_container_width=True, hide_index=True)
     else:
         st.write("No line items found")
+
+def _render_summary(invoice):
+    """Render the payment information and totals cards"""
+    pay = invoice.get('payment_info', {})
+    totals = invoice['totals']
+    currency = invoice['header'].get('currency', 'USD')
     
     # Summary and Payment Info
     col1, col2 = st.columns(2)
     
     with col1:
-        st.markdown('<div class="invoice-card">', unsafe_allow_html=True)
-        st.markdown('<div class="section-header">Payment Information</div>', unsafe_allow_html=True)
-        
-        payment_info = invoice.get('payment_info', {})
-        if payment_info.get('bank_name'):
-            st.write(f"**Bank:** {payment_info['bank_name']}")
-        if payment_info.get('iban'):
-            st.write(f"**IBAN:** `{payment_info['iban']}`")
-        if payment_info.get('swift_bic'):
-            st.write(f"**SWIFT/BIC:** `{payment_info['swift_bic']}`")
-        if payment_info.get('payment_reference'):
-            st.write(f"**Reference:** {payment_info['payment_reference']}")
-        
-        st.markdown('</div>', unsafe_allow_html=True)
+        lines = []
+        if pay.get('bank_name'):
+            lines.append(f"<p><strong>Bank:</strong> {html.escape(pay['bank_name'])}</p>")
+        if pay.get('iban'):
+            lines.append(f"<p><strong>IBAN:</strong> <code>{html.escape(pay['iban'])}</code></p>")
+        if pay.get('swift_bic'):
+            lines.append(f"<p><strong>SWIFT/BIC:</strong> <code>{html.escape(pay['swift_bic'])}</code></p>")
+        if pay.get('payment_reference'):
+            lines.append(f"<p><strong>Reference:</strong> {html.escape(pay['payment_reference'])}</p>")
+        st.html(_CARD.format("Payment Information", "".join(lines)))
     
     with col2:
-        st.markdown('<div class="invoice-card">', unsafe_allow_html=True)
-        st.markdown('<div class="section-header">Invoice Summary</div>', unsafe_allow_html=True)
-        
-        totals = invoice['totals']
-        currency = invoice['header'].get('currency', 'USD')
+        st.html(_SECTION_HEADER.format("Invoice Summary"))
         
-        summary_data = [
+        discount = totals.get('total_discount', 0)
+        summary_df = pd.DataFrame([
             ("Subtotal", f"{totals.get('subtotal', 0):,.2f} {currency}"),
-            ("Total Discount", f"-{totals.get('total_discount', 0):,.2f} {currency}" if totals.get('total_discount', 0) > 0 else f"0.00 {currency}"),
+            ("Total Discount", f"-{discount:,.2f} {currency}" if discount > 0 else f"0.00 {currency}"),
             ("Total VAT", f"{totals.get('total_vat', 0):,.2f} {currency}"),
-            ("**Total Amount**", f"**{totals.get('total_amount', 0):,.2f} {currency}**"),
+            ("Total Amount", f"{totals.get('total_amount', 0):,.2f} {currency}"),
             ("Amount Paid", f"{totals.get('amount_paid', 0):,.2f} {currency}"),
-            ("**Balance Due**", f"**{totals.get('balance_due', 0):,.2f} {currency}**")
-        ]
+            ("Balance Due", f"{totals.get('balance_due', 0):,.2f} {currency}")
+        ], columns=["Item", "Value"])
         
-        for label, value in summary_data:
-            col_a, col_b = st.columns([1, 1])
-            with col_a:
-                st.markdown(label)
-            with col_b:
-                if "Balance Due" in label and totals.get('balance_due', 0) > 0:
-                    st.markdown(f'<span style="color: #dc2626;">{value}</span>', unsafe_allow_html=True)
-                elif "Amount Paid" in label and totals.get('amount_paid', 0) > 0:
-                    st.markdown(f'<span style="color: #16a34a;">{value}</span>', unsafe_allow_html=True)
-                else:
-                    st.markdown(value)
+        def summary_row_style(row):
+            style = ""
+            if row["Item"] in ("Total Amount", "Balance Due"):
+                style = "font-weight: bold;"
+            if row["Item"] == "Balance Due" and totals.get('balance_due', 0) > 0:
+                style += "color: #dc2626;"
+            elif row["Item"] == "Amount Paid" and totals.get('amount_paid', 0) > 0:
+                style += "color: #16a34a;"
+            return ["", style]
         
-        st.markdown('</div>', unsafe_allow_html=True)
+        st.dataframe(
+            summary_df.style.apply(summary_row_style, axis=1),
+            hide_index=True,
+            use_container_width=True
+        )
+
+def display_invoice_data(data):
+    """Display extracted invoice data in a nice format"""
+    
+    if not data or 'invoice' not in data:
+        st.error("No invoice data to display")
+        return
+    
+    invoice = data['invoice']
+    
+    _render_header(invoice)
+    _render_billing_parties(invoice)
+    _render_line_items(invoice)
+    _render_summary(invoice)
+
+@st.fragment
+def render_invoice_tab(filename, data):
+    """Render one invoice tab; its download button only reruns this tab"""
+    display_invoice_data(data)
+    
+    # Individual download button
+    json_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    st.download_button(
+        label=f"📥 Download JSON",
+        data=json_bytes,
+        file_name=f"invoice_data_{filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+        mime="application/json",
+        key=f"download_{filename}"
+    )
 
 # Main app
 def main():
-    st.markdown('<div class="main-header"><h1>📄 Invoice Data Extractor</h1><p>Upload an invoice image and extract structured data using AI</p></div>', unsafe_allow_html=True)
+    st.html('<div class="main-header"><h1>📄 Invoice Data Extractor</h1><p>Upload an invoice image and extract structured data using AI</p></div>')
     
     # Sidebar for API key
     with st.sidebar:
         st.markdown("### Configuration")
         api_key = st.text_input("Anthropic API Key", type="password", help="Enter your Anthropic API key")
+        detail_level = st.select_slider(
+            "Image detail level",
+            options=list(DETAIL_LEVELS),
+            value="High",
+            help="Lower detail sends smaller images: faster and cheaper, but may miss fine print"
+        )
+        quality = st.radio(
+            "Quality vs cost",
+            options=list(QUALITY_MODES),
+            horizontal=True,
+            help="Economy tries Claude Haiku first and only escalates to Sonnet when its output fails validation"
+        )
+        mode = st.radio(
+            "Mode",
+            options=["Interactive", "Batch"],
+            horizontal=True,
+            help="Batch submits all invoices through the Message Batches API: half the cost, but results can take up to 24 hours"
+        )
+        
+        if st.button("🧹 Clear extraction cache", help="Forget cached results and re-extract on next run"):
+            clear_extraction_cache()
         
         st.markdown("### Instructions")
         st.markdown("""
@@ -355,6 +856,24 @@ def main():
         st.markdown("- Multiple languages")
         st.markdown("- Various invoice layouts")
     
+    # One client per API key, shared by every call in this and later reruns
+    client = get_client(api_key) if api_key else None
+    
+    # Initialize session state for multiple invoices
+    if 'all_extracted_data' not in st.session_state:
+        st.session_state.all_extracted_data = {}
+        st.session_state.restored_uploads = set()
+    
+    # Pending Message Batches API job
+    if 'invoice_batch' in st.session_state:
+        poll_invoice_batch(client)
+    
+    if 'batch_report' in st.session_state:
+        succeeded, failed = st.session_state.pop('batch_report')
+        st.success(f"✅ Batch finished: {succeeded} invoice(s) extracted")
+        for failure in failed:
+            st.error(f"Error processing {failure}")
+    
     # File upload - Multiple files
     uploaded_files = st.file_uploader(
         "Upload Invoice Images", 
@@ -366,9 +885,19 @@ def main():
     if uploaded_files:
         st.markdown(f"### {len(uploaded_files)} Invoice(s) Uploaded")
         
-        # Initialize session state for multiple invoices
-        if 'all_extracted_data' not in st.session_state:
-            st.session_state.all_extracted_data = {}
+        # Read each upload once; previews and extraction share the bytes
+        file_bytes = {f.name: f.getvalue() for f in uploaded_files}
+        
+        # Show cached results for images extracted before, e.g. prior to a page
+        # reload; each upload is checked once so Clear All Data stays cleared
+        for uploaded_file in uploaded_files:
+            if uploaded_file.file_id in st.session_state.restored_uploads:
+                continue
+            st.session_state.restored_uploads.add(uploaded_file.file_id)
+            cache_key = extraction_cache_key(file_bytes[uploaded_file.name], DETAIL_LEVELS[detail_level], QUALITY_MODES[quality])
+            data = lookup_extraction(cache_key)
+            if data is not None:
+                st.session_state.all_extracted_data.setdefault(uploaded_file.name, data)
         
         # Display uploaded images in a grid
         if len(uploaded_files) <= 3:
@@ -379,14 +908,17 @@ def main():
         for idx, uploaded_file in enumerate(uploaded_files):
             col_idx = idx % 3 if len(uploaded_files) > 3 else idx
             with cols[col_idx]:
-                image = Image.open(uploaded_file)
-                st.image(image, caption=f"{uploaded_file.name[:20]}...", use_container_width=True)
-                st.write(f"**Size:** {uploaded_file.size / 1024:.1f} KB")
+                preview, (width, height) = build_preview(file_bytes[uploaded_file.name])
+                st.image(preview, caption=f"{uploaded_file.name[:20]}...", use_container_width=True)
+                st.write(f"**Size:** {uploaded_file.size / 1024:.1f} KB · {width}×{height} px")
         
         # Batch processing options
         col1, col2 = st.columns([1, 1])
         with col1:
-            process_all = st.button("🔍 Process All Invoices", type="primary", use_container_width=True)
+            if mode == "Batch":
+                process_all = st.button("📨 Submit All as Batch", type="primary", use_container_width=True)
+            else:
+                process_all = st.button("🔍 Process All Invoices", type="primary", use_container_width=True)
         with col2:
             selected_invoice = st.selectbox(
                 "Or process individually:",
@@ -400,32 +932,35 @@ def main():
                 st.error("Please enter your Anthropic API key in the sidebar")
                 return
             
+            if mode == "Batch":
+                with st.spinner(f"Submitting {len(uploaded_files)} invoice(s)..."):
+                    try:
+                        submit_invoice_batch(file_bytes, client, DETAIL_LEVELS[detail_level], QUALITY_MODES[quality])
+                    except Exception as e:
+                        st.error(f"Error submitting batch: {str(e)}")
+                        return
+                st.rerun()
+            
             progress_bar = st.progress(0)
             status_text = st.empty()
             
             successful_extractions = 0
             failed_extractions = 0
             
-            for idx, uploaded_file in enumerate(uploaded_files):
-                status_text.text(f"Processing {uploaded_file.name}... ({idx + 1}/{len(uploaded_files)})")
-                progress_bar.progress((idx + 1) / len(uploaded_files))
+            status_text.text(f"Processing {len(uploaded_files)} invoice(s)...")
+            results = extract_many(file_bytes, client, DETAIL_LEVELS[detail_level], QUALITY_MODES[quality])
+            
+            for done, (filename, result) in enumerate(results, start=1):
+                status_text.text(f"Processed {filename} ({done}/{len(file_bytes)})")
+                progress_bar.progress(done / len(file_bytes))
                 
-                try:
-                    # Reset file pointer
-                    uploaded_file.seek(0)
-                    image_base64 = encode_image(uploaded_file)
-                    
-                    # Extract data
-                    extracted_data = extract_invoice_data(image_base64, api_key)
-                    
-                    if extracted_data:
-                        st.session_state.all_extracted_data[uploaded_file.name] = extracted_data
-                        successful_extractions += 1
-                    else:
-                        failed_extractions += 1
-                        
-                except Exception as e:
-                    st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+                if isinstance(result, Exception):
+                    st.error(f"Error processing {filename}: {describe_error(result)}")
+                    failed_extractions += 1
+                elif result:
+                    st.session_state.all_extracted_data[filename] = result
+                    successful_extractions += 1
+                else:
                     failed_extractions += 1
             
             status_text.text("Processing complete!")
@@ -443,25 +978,28 @@ def main():
                 st.error("Please enter your Anthropic API key in the sidebar")
                 return
             
-            selected_file = next(f for f in uploaded_files if f.name == selected_invoice)
-            
             with st.spinner(f"Processing {selected_invoice}..."):
                 try:
-                    # Reset file pointer
-                    selected_file.seek(0)
-                    image_base64 = encode_image(selected_file)
+                    # Extract data, streaming the response into a progress bar
+                    progress_bar = st.progress(0.0, text="Waiting for response...")
+                    
+                    def show_progress(received):
+                        progress_bar.progress(
+                            min(received / EXPECTED_RESPONSE_CHARS, 1.0),
+                            text=f"Receiving data... {received:,} characters"
+                        )
                     
-                    # Extract data
-                    extracted_data = extract_invoice_data(image_base64, api_key)
+                    extracted_data = extract_invoice_data(file_bytes[selected_invoice], client, DETAIL_LEVELS[detail_level], QUALITY_MODES[quality], show_progress)
+                    progress_bar.empty()
                     
                     if extracted_data:
-                        st.session_state.all_extracted_data[selected_file.name] = extracted_data
+                        st.session_state.all_extracted_data[selected_invoice] = extracted_data
                         st.success(f"✅ Successfully processed {selected_invoice}!")
                     else:
                         st.error(f"❌ Failed to process {selected_invoice}")
                         
                 except Exception as e:
-                    st.error(f"Error processing {selected_invoice}: {str(e)}")
+                    st.error(f"Error processing {selected_invoice}: {describe_error(e)}")
         
         # Display extracted data
         if st.session_state.all_extracted_data:
@@ -476,10 +1014,10 @@ def main():
                 display_invoice_data(data)
                 
                 # Download button
-                json_str = json.dumps(data, indent=2, ensure_ascii=False)
+                json_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2)
                 st.download_button(
                     label=f"📥 Download {filename} JSON",
-                    data=json_str,
+                    data=json_bytes,
                     file_name=f"invoice_data_{filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
                     mime="application/json",
                     use_container_width=True
@@ -492,17 +1030,7 @@ def main():
                 
                 for tab, filename in zip(tabs, tab_names):
                     with tab:
-                        display_invoice_data(st.session_state.all_extracted_data[filename])
-                        
-                        # Individual download button
-                        json_str = json.dumps(st.session_state.all_extracted_data[filename], indent=2, ensure_ascii=False)
-                        st.download_button(
-                            label=f"📥 Download JSON",
-                            data=json_str,
-                            file_name=f"invoice_data_{filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                            mime="application/json",
-                            key=f"download_{filename}"
-                        )
+                        render_invoice_tab(filename, st.session_state.all_extracted_data[filename])
                 
                 # Bulk download button
                 st.markdown("---")
@@ -511,10 +1039,10 @@ def main():
                 with col1:
                     # Download all as single JSON
                     all_data = {"invoices": st.session_state.all_extracted_data}
-                    all_json_str = json.dumps(all_data, indent=2, ensure_ascii=False)
+                    all_json_bytes = orjson.dumps(all_data, option=orjson.OPT_INDENT_2)
                     st.download_button(
                         label="📥 Download All JSON Data",
-                        data=all_json_str,
+                        data=all_json_bytes,
                         file_name=f"all_invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
                         mime="application/json",
                         use_container_width=True
@@ -522,32 +1050,11 @@ def main():
                 
                 with col2:
                     # Create summary CSV
-                    summary_data = []
-                    for filename, data in st.session_state.all_extracted_data.items():
-                        invoice = data.get('invoice', {})
-                        summary_data.append({
-                            'filename': filename,
-                            'invoice_number': invoice.get('header', {}).get('invoice_number', ''),
-                            'company': invoice.get('billing_parties', {}).get('bill_from', {}).get('company_name', ''),
-                            'total_amount': invoice.get('totals', {}).get('total_amount', 0),
-                            'currency': invoice.get('header', {}).get('currency', ''),
-                            'balance_due': invoice.get('totals', {}).get('balance_due', 0),
-                            'invoice_date': invoice.get('header', {}).get('invoice_date', ''),
-                            'due_date': invoice.get('header', {}).get('due_date', '')
-                        })
-                    
-                    import csv
-                    import io
-                    
-                    csv_buffer = io.StringIO()
-                    if summary_data:
-                        writer = csv.DictWriter(csv_buffer, fieldnames=summary_data[0].keys())
-                        writer.writeheader()
-                        writer.writerows(summary_data)
+                    csv_bytes = build_summary_csv(st.session_state.all_extracted_data)
                     
                     st.download_button(
                         label="📊 Download Summary CSV",
-                        data=csv_buffer.getvalue(),
+                        data=csv_bytes,
                         file_name=f"invoice_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
                         mime="text/csv",
                         use_container_width=True
@@ -561,7 +1068,7 @@ def main():
                 st.rerun()
     
     # Display previously extracted data if available and no new files uploaded
-    elif 'all_extracted_data' in st.session_state and st.session_state.all_extracted_data:
+    elif st.session_state.all_extracted_data:
         st.info("Showing previously extracted data. Upload new invoices to process fresh data.")
         
         # Display in tabs if multiple, single view if one